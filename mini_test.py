@@ -12,8 +12,18 @@ def factorial(n):
 
 probed_factorial = probe()(factorial)
 
+@memoize(return_copy=True)
+def returns_none():
+    returns_none.calls += 1
+    return None
+
+returns_none.calls = 0
+
 if __name__ == '__main__':
     probed_factorial(1)
+    returns_none()
+    returns_none()
+    assert returns_none.calls == 1, "None should be memoized like any other value"
     factorial(-1)
     for k in range(100, 110):
         factorial(k)
@@ -24,11 +24,14 @@ setuptools.setup(
         'wasabi>=0.4',
         'dill>=0.3.1.1',
     ],
+    extras_require={
+        'orjson': ['orjson>=3.0'],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "Development Status :: 4 - Beta",
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.7',
 )
@@ -1,22 +1,135 @@
 """
 Decorators for common Python developer utility.
 """
-from functools import wraps
-from collections import OrderedDict
-from time import time
+from functools import wraps, lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter_ns, process_time_ns
 from pprint import pformat
 from copy import deepcopy
 import random
 import json
+import math
+import enum
+import uuid
 import os
-import dill as pickle
+import sys
+import atexit
+import threading
+import pickle
+import dill
 import inspect
 import traceback
 import wasabi
 from wasabi import msg as logger
 
+
+def _json_dumps(obj):
+    """Serialize an object to a JSON string with sorted keys, using the standard library.
+
+    :param obj: a JSON-serializable object.
+    :returns: str -- the JSON string.
+    """
+    return json.dumps(obj, ensure_ascii=False, sort_keys=True)
+
+
+# orjson is an optional, faster serializer for the string form of arguments
+try:
+    import orjson
+
+    # hand anything json would reject back to json, instead of letting orjson encode it
+    _ORJSON_OPTIONS = (
+        orjson.OPT_SORT_KEYS
+        | orjson.OPT_PASSTHROUGH_DATETIME
+        | orjson.OPT_PASSTHROUGH_DATACLASS
+        | orjson.OPT_PASSTHROUGH_SUBCLASS
+    )
+
+    def _orjson_default(obj):
+        """Reject types orjson does not encode natively, as json would.
+
+        :param obj: the object orjson could not serialize.
+        """
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+    def _needs_json(obj):
+        """Check for values that orjson encodes natively but json either rejects or writes differently.
+
+        :param obj: a JSON-serializable object.
+        :returns: bool -- True if obj holds a non-finite float, a plain Enum or a UUID.
+        """
+        if isinstance(obj, float):
+            return not math.isfinite(obj)
+        if isinstance(obj, dict):
+            return any(_needs_json(_value) for _value in obj.values())
+        if isinstance(obj, (list, tuple)):
+            return any(_needs_json(_value) for _value in obj)
+        # int/float/str-valued enums are written the same way by both
+        return isinstance(obj, uuid.UUID) or (
+            isinstance(obj, enum.Enum) and not isinstance(obj, (int, float, str))
+        )
+
+    def _dumps(obj):
+        """Serialize an object like _json_dumps(), using orjson where it gives the same meaning.
+
+        :param obj: a JSON-serializable object.
+        :returns: str -- the JSON string.
+        """
+        if _needs_json(obj):
+            return _json_dumps(obj)
+        try:
+            return orjson.dumps(obj, default=_orjson_default, option=_ORJSON_OPTIONS).decode("utf-8")
+        except orjson.JSONEncodeError:
+            # e.g. integers beyond 64 bits, non-str keys in nested dicts, or types json rejects too
+            return _json_dumps(obj)
+
+
+except ImportError:
+    _dumps = _json_dumps
+
+
 INFO_COLOR = "blue"
 THEME_COLORS = ["green", "black", "red", "cyan", "yellow"]
+IMMUTABLE_TYPES = (int, float, complex, str, bytes, bool, type(None))
+# environment variables that turn decorators into no-ops, checked at decoration time
+DISABLE_PROBES_ENV = "WRAPPY_DISABLE_PROBES"
+DISABLE_GUARDS_ENV = "WRAPPY_DISABLE_GUARDS"
+# distinguishes a cache miss from a memoized None
+_MISSING = object()
+# caller names by call site, bounded and dropped in a FIFO manner
+CALLER_NAME_CACHE_LIMIT = 1024
+_caller_name_cache = dict()
+# the newest protocol handles large binary payloads most efficiently
+PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL
+# a larger read buffer for replaying persisted logs
+PERSIST_READ_BUFFER_SIZE = 1 << 20
+# one-byte headers that tag which serializer wrote a persisted file
+PICKLE_HEADER = b"P"
+DILL_HEADER = b"D"
+
+# a single worker serializes persistence in the background, in submission order
+_persist_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="wrappy-persist")
+# make sure pending writes are flushed before the interpreter exits
+atexit.register(_persist_executor.shutdown, wait=True)
+
+
+def _env_flag(name):
+    """Check whether an environment variable is set to a truthy value.
+
+    :param name: the name of the environment variable.
+    :type name: str
+    :returns: bool -- False if unset, empty, "0" or "false" (case-insensitive), otherwise True.
+    """
+    return os.environ.get(name, "").lower() not in ("", "0", "false")
+
+
+def _identity_decorator(func):
+    """A decorator that returns the function unchanged.
+
+    :param func: the function to decorate.
+    :type func: callable
+    :returns: callable -- the same function.
+    """
+    return func
 
 
 def probe(
@@ -25,6 +138,8 @@ def probe(
     show_kwargs=False,
     show_returns=False,
     random_theme=True,
+    sample_rate=1.0,
+    cpu_time=False,
 ):
     """Builds a customized decorator that prints information at runtime.
 
@@ -38,8 +153,19 @@ def probe(
     :type show_returns: bool
     :param random_theme: whether to use a random color scheme for better distinguishment against other 'probed' functions.
     :type random_theme: bool
+    :param sample_rate: the fraction of calls to probe, chosen at random. Lower rates trade completeness for overhead, like a sampling profiler versus a tracing one.
+    :type sample_rate: float
+    :param cpu_time: whether to measure CPU time of the current process instead of elapsed time.
+    :type cpu_time: bool
     :returns: callable -- a parametrized decorator.
+
+    Setting the environment variable WRAPPY_DISABLE_PROBES=1 leaves decorated functions unwrapped.
     """
+    if _env_flag(DISABLE_PROBES_ENV):
+        return _identity_decorator
+
+    assert 0.0 < sample_rate <= 1.0, "Expected a sample rate in (0, 1]."
+
     # random color theme produces better distinguishment between different probes
     # which becomes relevant when probing along a call chain
     if random_theme:
@@ -51,55 +177,95 @@ def probe(
         fore_color = "white"
         back_color = THEME_COLORS[0]
 
+    caller_max_level = show_caller if isinstance(show_caller, int) else 1
+
+    # both clocks are monotonic integer nanosecond counters
+    timer = process_time_ns if cpu_time else perf_counter_ns
+    time_kind = "CPU" if cpu_time else "running"
+
     def wrapper(func):
+        # these never change after decoration, so introspect and format them only once
+        # (not every callable supports introspection, so only do it when needed)
+        arg_names = []
+        if show_args:
+            try:
+                arg_names = inspect.getfullargspec(func).args
+            except TypeError:
+                # e.g. functools.partial objects or some builtins, whose positional args are then not shown
+                pass
+        func_name = wasabi.color(
+            getattr(func, "__qualname__", repr(func)), fg=fore_color, bg=back_color, bold=True
+        )
+        module_name = wasabi.color(
+            str(getattr(func, "__module__", None)), fg=fore_color, bg=back_color, bold=True
+        )
+        probe_divider = f"Probing {func_name}"
+        module_divider = f"From module {module_name}"
+        caller_divider = f"{func_name} caller"
+        args_divider = f"{func_name} args"
+        kwargs_divider = f"{func_name} kwargs"
+        begin_divider = f"{func_name} begins execution"
+        time_message = f"{func_name} {time_kind} time:"
+        returns_divider = f"{func_name} returns"
+
+        def log_caller(args, kwargs):
+            logger.divider(caller_divider, char="-")
+            # skip this function, probed_func, and get_caller_name itself
+            for _level in range(caller_max_level):
+                format_caller_name = wasabi.color(
+                    get_caller_name(_level + 3), fg=INFO_COLOR, bold=True
+                )
+                logger.text(f"Level {_level+1} {format_caller_name}")
+
+        def log_args(args, kwargs):
+            format_args = dict()
+            for _arg_name, _arg_value in zip(arg_names, args):
+                format_args[
+                    wasabi.color(_arg_name, fg=INFO_COLOR, bold=True)
+                ] = pformat(_arg_value)
+            logger.divider(args_divider, char="-")
+            print(wasabi.table(format_args))
+
+        def log_kwargs(args, kwargs):
+            format_kwargs = dict()
+            for _kwarg_name, _kwarg_value in kwargs.items():
+                format_kwargs[
+                    wasabi.color(_kwarg_name, fg=INFO_COLOR, bold=True)
+                ] = pformat(_kwarg_value)
+            logger.divider(kwargs_divider, char="-")
+            print(wasabi.table(format_kwargs))
+
+        # select the logging steps once, so that calls do not re-check the flags
+        pre_call_steps = tuple(
+            _step
+            for _step, _flag in [
+                (log_caller, show_caller),
+                (log_args, show_args),
+                (log_kwargs, show_kwargs),
+            ]
+            if _flag
+        )
+
         @wraps(func)
         def probed_func(*args, **kwargs):
-            func_name = wasabi.color(
-                func.__qualname__, fg=fore_color, bg=back_color, bold=True
-            )
-            module_name = wasabi.color(
-                func.__module__, fg=fore_color, bg=back_color, bold=True
-            )
-            logger.divider(f"Probing {func_name}")
-            logger.divider(f"From module {module_name}", char="_")
-
-            if show_caller:
-                caller_max_level = show_caller if isinstance(show_caller, int) else 1
-                caller_names = [get_caller_name(k + 3) for k in range(caller_max_level)]
-                logger.divider(f"{func_name} caller", char="-")
-                for i, _caller_name in enumerate(caller_names):
-                    format_caller_name = wasabi.color(
-                        _caller_name, fg=INFO_COLOR, bold=True
-                    )
-                    logger.text(f"Level {i+1} {format_caller_name}")
-
-            if show_args:
-                args_zip = zip(inspect.getargspec(func).args, args)
-                format_args = dict()
-                for _arg_name, _arg_value in args_zip:
-                    format_args[
-                        wasabi.color(_arg_name, fg=INFO_COLOR, bold=True)
-                    ] = pformat(_arg_value)
-                logger.divider(f"{func_name} args", char="-")
-                print(wasabi.table(format_args))
-
-            if show_kwargs:
-                format_kwargs = dict()
-                for _kwarg_name, _kwarg_value in kwargs.items():
-                    format_kwargs[
-                        wasabi.color(_kwarg_name, fg=INFO_COLOR, bold=True)
-                    ] = pformat(_kwarg_value)
-                logger.divider(f"{func_name} kwargs", char="-")
-                print(wasabi.table(format_kwargs))
-
-            logger.divider(f"{func_name} begins execution", char="-")
-            tic = time()
+            # calls left out of the sample run without any probing overhead
+            if sample_rate < 1.0 and random.random() >= sample_rate:
+                return func(*args, **kwargs)
+
+            logger.divider(probe_divider)
+            logger.divider(module_divider, char="_")
+
+            for _step in pre_call_steps:
+                _step(args, kwargs)
+
+            logger.divider(begin_divider, char="-")
+            tic = timer()
             retval = func(*args, **kwargs)
-            toc = time()
-            logger.info(f"{func_name} running time: {toc - tic} seconds.")
+            toc = timer()
+            logger.info(f"{time_message} {(toc - tic) / 1e9} seconds.")
 
             if show_returns:
-                logger.divider(f"{func_name} returns", char="-")
+                logger.divider(returns_divider, char="-")
                 print(pformat(retval))
 
             logger.divider()
@@ -117,23 +283,38 @@ def get_caller_name(skip=2):
     :type skip: int
     :returns: str -- "<module>.<class>.<method>" or "<module>.<function>".
     """
-    stack = inspect.stack()
-    if len(stack) < skip + 1:
+    # fetch only the frame of interest, without building (and reading source for) the whole stack
+    try:
+        parentframe = sys._getframe(skip)
+    except ValueError:
         return ""
-    parentframe = stack[skip][0]
+
+    # the same code (and class, for methods) always gives the same name
+    f_locals = parentframe.f_locals
+    self_class = f_locals["self"].__class__ if "self" in f_locals else None
+    cache_key = (parentframe.f_code, self_class)
+    if cache_key in _caller_name_cache:
+        del parentframe, f_locals
+        return _caller_name_cache[cache_key]
 
     name = []
-    module = inspect.getmodule(parentframe)
-    if module:
-        name.append(module.__name__)
+    module_name = parentframe.f_globals.get("__name__")
+    if module_name:
+        name.append(module_name)
 
-    if "self" in parentframe.f_locals:
-        name.append(parentframe.f_locals["self"].__class__.__name__)
+    if self_class is not None:
+        name.append(self_class.__name__)
     codename = parentframe.f_code.co_name
     if codename != "<module>":
         name.append(codename)
-    del parentframe
-    return ".".join(name)
+    del parentframe, f_locals
+
+    caller_name = ".".join(name)
+    _caller_name_cache[cache_key] = caller_name
+    if len(_caller_name_cache) > CALLER_NAME_CACHE_LIMIT:
+        # other threads may evict concurrently, so tolerate the key being gone already
+        _caller_name_cache.pop(next(iter(_caller_name_cache), None), None)
+    return caller_name
 
 
 def todo(message="This functions is not yet implemented."):
@@ -172,7 +353,12 @@ def guard(fallback_retval=0, fallback_func=None, print_traceback=False):
         @guard(fallback_retval=0)
         def divide(a, b):
             return a / b
+
+    Setting the environment variable WRAPPY_DISABLE_GUARDS=1 leaves decorated functions unwrapped, so exceptions propagate.
     """
+    if _env_flag(DISABLE_GUARDS_ENV):
+        return _identity_decorator
+
     # determine which fallback to use later
     if fallback_func is not None:
         assert callable(fallback_func), "Expected a callable as the fallback function."
@@ -188,16 +374,14 @@ def guard(fallback_retval=0, fallback_func=None, print_traceback=False):
         @wraps(func)
         def guarded_func(*args, **kwargs):
             try:
-                retval = func(*args, **kwargs)
+                return func(*args, **kwargs)
             except Exception as e:
                 logger.warn(
                     f"Guarding function {func.__module__}.{func.__qualname__}: suppressing {type(e)}: {e}"
                 )
                 if print_traceback:
                     traceback.print_exc()
-                retval = fallback(*args, **kwargs)
-            finally:
-                return retval
+                return fallback(*args, **kwargs)
 
         return guarded_func
 
@@ -212,67 +396,308 @@ def args_as_string(*args, **kwargs):
     :returns: str -- string representation of all arguments.
     """
     args_str_form = ", ".join([_arg.__repr__() for _arg in args])
-    kwargs_str_form = json.dumps(kwargs, ensure_ascii=False, sort_keys=True)
+    kwargs_str_form = _dumps(kwargs)
     return f"args: {args_str_form}, kwargs: {kwargs_str_form}"
 
 
-def memoize(cache_limit=1000, return_copy=False, persist_path=None, persist_batch_size=1000):
-    """Memoize the output of a function with an OrderedDict for least-recently-used(LRU) caching.
+def _fast_key(args, kwargs):
+    """Turn arguments and keyword arguments into a lookup key, avoiding string conversion when possible.
+
+    :param args: positional arguments.
+    :type args: tuple
+    :param kwargs: keyword arguments, order-insensitive.
+    :type kwargs: dict
+    :returns: tuple or str -- a hashable tuple of the arguments, or args_as_string() if any argument is unhashable.
+    """
+    key = (args, tuple(sorted(kwargs.items())) if kwargs else ())
+    # tuples only hash their members upon hashing, so check explicitly
+    try:
+        hash(key)
+    except TypeError:
+        return args_as_string(*args, **kwargs)
+    return key
+
+
+def _is_immutable(value):
+    """Determine whether a value can be safely shared without copying.
+
+    :param value: the value to check.
+    :returns: bool -- True for scalars, and for tuples/frozensets whose members are all immutable.
+    """
+    if isinstance(value, IMMUTABLE_TYPES):
+        return True
+    if isinstance(value, (tuple, frozenset)):
+        # hashable is not enough: user-defined objects hash by identity but can still be mutated
+        return all(_is_immutable(_member) for _member in value)
+    return False
+
+
+def _dump_record(record):
+    """Serialize a single record, using pickle when possible and dill otherwise.
+
+    :param record: the record to persist, typically a (key, value) pair.
+    :returns: bytes -- a one-byte header followed by the pickled record.
+    """
+    try:
+        return PICKLE_HEADER + pickle.dumps(record, protocol=PICKLE_PROTOCOL)
+    except (TypeError, AttributeError, pickle.PicklingError):
+        return DILL_HEADER + dill.dumps(record, protocol=PICKLE_PROTOCOL)
+
+
+def _dump_records(records):
+    """Serialize records for the persisted log, skipping (with a warning) those that cannot be serialized.
+
+    :param records: the (key, value) pairs to persist.
+    :type records: list
+    :returns: bytes -- the serialized records, back to back.
+    """
+    chunks = []
+    for _record in records:
+        try:
+            chunks.append(_dump_record(_record))
+        except Exception as e:
+            logger.warn(f"Not persisting memoized value for {_record[0]}: {type(e)}: {e}")
+    return b"".join(chunks)
+
+
+def _report_persist_failure(future):
+    """Warn about a background persistence task that raised, since nobody waits on its result.
+
+    :param future: the finished persistence task.
+    :type future: concurrent.futures.Future
+    """
+    if future.cancelled():
+        return
+    exception = future.exception()
+    if exception is not None:
+        logger.warn(f"Failed to persist memoized values: {type(exception)}: {exception}")
+
+
+def _submit_persist(persist_func, payload, persist_path):
+    """Run a persistence function in the background, reporting any failure.
+
+    :param persist_func: _append_records or _compact_records.
+    :type persist_func: callable
+    :param payload: records already serialized by _dump_records().
+    :type payload: bytes
+    :param persist_path: the path to persist to.
+    :type persist_path: str
+    """
+    future = _persist_executor.submit(persist_func, payload, persist_path)
+    future.add_done_callback(_report_persist_failure)
+    return future
+
+
+def _append_records(payload, persist_path):
+    """Append serialized records to the end of a persisted log.
+
+    :param payload: records serialized by _dump_records().
+    :type payload: bytes
+    :param persist_path: the path to persist to.
+    :type persist_path: str
+    """
+    with open(persist_path, "ab") as f:
+        f.write(payload)
+
+
+def _compact_records(payload, persist_path):
+    """Atomically rewrite a persisted log by writing to a temporary file and then replacing the target.
+
+    :param payload: all the records to keep, serialized by _dump_records().
+    :type payload: bytes
+    :param persist_path: the path to persist to.
+    :type persist_path: str
+    """
+    tmp_path = f"{persist_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(payload)
+    os.replace(tmp_path, persist_path)
+
+
+def _load_records(f):
+    """Iterate over the records persisted by _dump_record().
+
+    :param f: a file object opened in binary read mode.
+    :returns: generator -- (key, value) pairs in the order they were written.
+    """
+    header = f.read(1)
+    while header:
+        if header == PICKLE_HEADER:
+            yield pickle.load(f)
+        elif header == DILL_HEADER:
+            yield dill.load(f)
+        else:
+            raise pickle.UnpicklingError(f"Unknown record header {header}.")
+        header = f.read(1)
+
+
+def memoize(
+    cache_limit=1000,
+    return_copy=False,
+    persist_path=None,
+    persist_batch_size=1000,
+    copy_method="pickle",
+):
+    """Memoize the output of a function with an insertion-ordered dict for least-recently-used(LRU) caching.
     Optionally persist results to disk.
+
+    Without persistence or copying, this delegates to functools.lru_cache, in which case all arguments must be hashable.
     
     :param cache_limit: the maximum number of distinct inputs to memoize.
     :type cache_limit: int
     :param return_copy: whether to return a (deep) copy of the memoized value.
     :type return_copy: bool
-    :param persist_path: the path to store results using pickle (dill).
+    :param persist_path: the path to store results using pickle, or dill for objects that pickle cannot handle.
     :type persist_path: str
     :param persist_batch_size: the number of updates between persisting.
     :type persist_batch_size: int
+    :param copy_method: how to copy mutable memoized values when return_copy is set, 'pickle' (falling back to deepcopy for unpicklable values) or 'deepcopy'.
+    :type copy_method: str
     :returns: callable -- a parametrized decorator.
     """
+    assert copy_method in ("pickle", "deepcopy"), f"Unsupported copy method {copy_method}."
     if persist_path is not None:
         assert isinstance(persist_path, str)
         assert isinstance(persist_batch_size, int) and persist_batch_size >= 1
 
     def wrapper(func):
+        # the standard library cache is implemented in C and suffices for the in-memory case
+        if persist_path is None and not return_copy:
+            return lru_cache(maxsize=cache_limit)(func)
+
         if persist_path:
             logger.info(
-                f"Persisting {func.__module__}.{func.__qualname__}() output to {persist_path}."
+                f"Persisting {func.__module__}.{func.__qualname__}() output to {persist_path} with pickle protocol {PICKLE_PROTOCOL}."
             )
-            # load or initialize memory
-            if os.path.isfile(persist_path):
-                with open(persist_path, "rb") as f:
-                    memory = pickle.load(f)
+        memory = dict()
+        # keep track of update/load status, and how many records the persisted log holds
+        state_dict = dict(updates=0, logged=0, loaded=not persist_path)
+        # new entries that have yet to be appended to the persisted log
+        pending = []
+
+        def load_memory():
+            # runs once with the lock held, on the first call rather than at decoration (often import) time
+            state_dict['loaded'] = True
+            if not os.path.isfile(persist_path):
+                return
+            # replay the log, where later records are more recent
+            with open(persist_path, "rb", buffering=PERSIST_READ_BUFFER_SIZE) as f:
+                legacy = f.read(1) not in (PICKLE_HEADER, DILL_HEADER, b"")
+                f.seek(0)
+                truncated = False
+                if legacy:
+                    # older versions keyed every entry by args_as_string(), which lookups no longer use
+                    logger.warn(
+                        f"Discarding {persist_path}: it was written by an older version of wrappy and its keys are incompatible."
+                    )
+                else:
+                    try:
+                        for _key, _value in _load_records(f):
+                            memory.pop(_key, None)
+                            memory[_key] = _value
+                            state_dict['logged'] += 1
+                            if len(memory) > cache_limit:
+                                del memory[next(iter(memory))]
+                    except (EOFError, pickle.UnpicklingError) as e:
+                        # appends are not atomic, so an interrupted process can leave a torn last record
+                        truncated = True
+                        logger.warn(
+                            f"Stopped reading {persist_path} at a truncated record: {type(e)}: {e}"
+                        )
+            # older formats and torn logs cannot be appended to, so rewrite them right away
+            if legacy or truncated:
+                state_dict['logged'] = len(memory)
+                _submit_persist(_compact_records, _dump_records(memory.items()), persist_path)
+
+        # keep track of which memoized values do not need copying
+        immutable = dict()
+        # guards updates to the memory; lookups go without it
+        lock = threading.Lock()
+
+        def persist_pending():
+            # serialize now, with the lock held by the caller, so that callers mutating returned values
+            # cannot race the background write; only the file I/O happens in the background
+            records = pending[:]
+            pending.clear()
+            state_dict['updates'] = 0
+            state_dict['logged'] += len(records)
+            # rewrite the log once it grows well beyond the memory
+            if state_dict['logged'] > 2 * len(memory):
+                records = list(memory.items())
+                state_dict['logged'] = len(records)
+                _submit_persist(_compact_records, _dump_records(records), persist_path)
             else:
-                memory = OrderedDict()
-        else:
-            memory = OrderedDict()
-        # keep track of update status
-        state_dict = dict(updates=0)
+                _submit_persist(_append_records, _dump_records(records), persist_path)
+
+        def flag_immutable(key, value):
+            # called with the lock held, while the key is in the memory
+            is_immutable = immutable.get(key)
+            if is_immutable is None:
+                is_immutable = immutable[key] = _is_immutable(value)
+            return is_immutable
 
         @wraps(func)
         def memoized_func(*args, **kwargs):
-            lookup_key = args_as_string(*args, **kwargs)
-            if lookup_key in memory:
+            if not state_dict['loaded']:
+                with lock:
+                    if not state_dict['loaded']:
+                        load_memory()
+            lookup_key = _fast_key(args, kwargs)
+            retval = memory.get(lookup_key, _MISSING)
+            # flags are only read or written with the lock held, next to the value they describe
+            is_immutable = None
+            if retval is not _MISSING:
                 # if already memoized, refresh to the last-in position in the memory
-                retval = memory[lookup_key]
-                memory.move_to_end(lookup_key, last=True)
+                with lock:
+                    if lookup_key in memory:
+                        retval = memory.pop(lookup_key)
+                        memory[lookup_key] = retval
+                        if return_copy:
+                            is_immutable = flag_immutable(lookup_key, retval)
             else:
-                # if not memoized, compute the value and store it in the memory
-                retval = func(*args, **kwargs)
-                memory[lookup_key] = retval
-                state_dict['updates'] += 1
-                # if memory if full, drop in a FIFO manner
-                if len(memory.keys()) > cache_limit:
-                    memory.popitem(last=False)
-
-            # count updates and persist to disk when enough evaluations have taken place
-            if persist_path and state_dict['updates'] >= persist_batch_size:
-                state_dict['updates'] = 0
-                with open(persist_path, "wb") as f:
-                    pickle.dump(memory, f)
-
-            return deepcopy(retval) if return_copy else retval
+                # if not memoized, compute the value outside the lock and store it in the memory
+                # concurrent misses (or a lookup during another thread's refresh) may compute it more than once
+                computed = func(*args, **kwargs)
+                with lock:
+                    retval = memory.get(lookup_key, _MISSING)
+                    if retval is not _MISSING:
+                        # another thread stored it meanwhile, so keep that value and record nothing new
+                        memory[lookup_key] = memory.pop(lookup_key)
+                        if return_copy:
+                            is_immutable = flag_immutable(lookup_key, retval)
+                    else:
+                        retval = computed
+                        memory[lookup_key] = retval
+                        immutable.pop(lookup_key, None)
+                        if return_copy:
+                            is_immutable = flag_immutable(lookup_key, retval)
+                        state_dict['updates'] += 1
+                        if persist_path:
+                            pending.append((lookup_key, retval))
+                        # if memory if full, drop in a FIFO manner
+                        if len(memory) > cache_limit:
+                            evicted_key = next(iter(memory))
+                            del memory[evicted_key]
+                            immutable.pop(evicted_key, None)
+
+                        # count updates and persist to disk when enough evaluations have taken place
+                        if persist_path and state_dict['updates'] >= persist_batch_size:
+                            persist_pending()
+
+            if not return_copy:
+                return retval
+            # the key got evicted before the lock was taken, so check without caching the flag
+            if is_immutable is None:
+                is_immutable = _is_immutable(retval)
+            if is_immutable:
+                return retval
+            if copy_method == "pickle":
+                # some values, e.g. instances of local classes, can only be deep-copied
+                try:
+                    return pickle.loads(pickle.dumps(retval, protocol=PICKLE_PROTOCOL))
+                except (pickle.PicklingError, TypeError, AttributeError):
+                    pass
+            return deepcopy(retval)
 
         return memoized_func
 